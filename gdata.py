@@ -6,9 +6,11 @@
 
 import os
 import sys
-import textwrap
+import threading
 import groceryDatabase
-import terminal
+
+# terminal, textwrap and datetime are imported by the subcommands that use
+# them so that commands like help start quickly
 
 _commands = {}
 
@@ -16,7 +18,96 @@ def command(function):
     _commands[function.__name__] = function.__doc__
     return function
 
+def _name_candidates(data, string):
+    """Find entry names starting with string
+
+    Parameters
+    ----------
+    data : dict
+        Completion data, see groceryDatabase.completion_data
+    string : string
+        The start of the name
+
+    Returns
+    -------
+    list
+        Sorted list of matching names
+    """
+    return [name for name in data["names"] if name.startswith(string)]
+
+def _tag_candidates(data, name, string):
+    """Find tags of an entry name starting with string
+
+    Parameters
+    ----------
+    data : dict
+        Completion data, see groceryDatabase.completion_data
+    name : string
+        Name of the entry
+    string : string
+        The start of the tag
+
+    Returns
+    -------
+    list
+        Sorted list of matching tags
+    """
+    return [tag for tag in data["tags"].get(name, []) if tag.startswith(string)]
+
+def _tabcomplete_text(options, string):
+    """Get the text and tips of tab completion
+
+    Parameters
+    ----------
+    options : list
+        The possible completions of string
+    string : string
+        The string to complete
+
+    Returns
+    -------
+    text : string
+        The text to add to string
+    tips : string
+        The options, if there is more than one
+    """
+    prefix = os.path.commonprefix(options)
+
+    text = ""
+    if len(prefix) != 0:
+        text = prefix[len(string):]
+
+    tips = ""
+    if len(options) > 1:
+        tips = _tabcomplete_tips(options)
+    return text, tips
+
+def _tabcomplete_tips(options):
+    """Format options as tab completion tips, three per line
+
+    Parameters
+    ----------
+    options : list
+        The options to display
+
+    Returns
+    -------
+    string
+        The formatted options
+    """
+    tips = ""
+    for i, option in enumerate(options[:-1]):
+        tips = tips + option
+        if (i + 1)%3 == 0:
+            tips = tips + "\n"
+        else:
+            tips = tips + ", "
+
+    return tips + options[-1]
+
 class gdatabaseUtility:
+    _checkpoint_interval = 10
+
     def __init__(self, command, arg=""):
         """Initalize gdatabasUtility
 
@@ -27,7 +118,8 @@ class gdatabaseUtility:
         arg : string
             Arguments for the command.
         """
-        self.database = groceryDatabase.groceryDatabase()
+        self._database = None
+        self._database_lock = threading.Lock()
 
         function = None
 
@@ -45,6 +137,18 @@ class gdatabaseUtility:
             #close program silently
             print("\n")
 
+    @property
+    def database(self):
+        """The database, loaded the first time it is used.
+
+        Tab completion can use it from a background thread, so it is
+        loaded under a lock.
+        """
+        with self._database_lock:
+            if self._database is None:
+                self._database = groceryDatabase.groceryDatabase()
+            return self._database
+
     @command
     def list(self, arg):
         """List the contents of the database.
@@ -104,6 +208,11 @@ class gdatabaseUtility:
                         print("Malformed command 3")
                         return
 
+        # load the database before any entry is made so new entries get the
+        # next free id
+        database = self.database
+
+        import terminal
         with terminal.terminal() as term:
             while name is None:
                 name = str(term.input("Enter entry name: ", self._tabcomplete_name())).strip()
@@ -137,22 +246,31 @@ class gdatabaseUtility:
             new_attribute = groceryDatabase.attribute(name, value, unit)
             new_entry.add_attribute(new_attribute)
 
-        self.database.add_entry(new_entry)
-        self.database.update()
+        database.add_entry(new_entry)
+        database.update()
 
     @command
     def add(self, arg):
         """Add a food entry to database.
 
+        With --session several entries are added in one go. The date and
+        tags given at the start of the session are shared by all entries,
+        leave the entry name blank to finish the session.
+
         Examples:
             add name, tag,...,tag
             add name
             add
+            add --session tag,...,tag
+            add --session
         """
 
         name = None
         tags = None
-        attributes = []
+
+        if arg.strip().startswith("--session"):
+            self._add_session(arg.strip()[len("--session"):])
+            return
 
         if len(arg.strip()) != 0:
             arg = arg.split(",", 1)
@@ -165,65 +283,303 @@ class gdatabaseUtility:
                 if len(tags) == 0:
                     tags = None
 
+        # load the database before any entry is made so new entries get the
+        # next free id
+        database = self.database
+
+        import terminal
         with terminal.terminal() as term:
-            while name is None:
-                name = str(term.input("Enter entry name: ", self._tabcomplete_name())).strip()
-                if len(name) == 0:
-                    name = None
+            new_entry = self._input_food(term, name, tags)
 
-            if tags is None:
-                tags = str(term.input("Enter tags(comma separated): ", self._tabcomplete_tag(name))).strip()
-                tags = [tag.strip() for tag in tags.split(",") if len(tag.strip()) != 0]
+        database.add_entry(new_entry)
+        database.update()
+
+    def _add_session(self, arg):
+        """Add food entries to the database until a blank name is entered.
+
+        The new entries are saved every _checkpoint_interval entries and
+        when the session ends.
+
+        Parameters
+        ----------
+        arg : string
+            Comma separated tags shared by all entries in the session.
+        """
+        import datetime
+        import terminal
+
+        # load the database before any entry is made so new entries get the
+        # next free id
+        database = self.database
+
+        shared_tags = [tag.strip() for tag in arg.split(",") if len(tag.strip()) != 0]
+        date = None
+        unsaved = 0
+        backup = True
+
+        try:
+            with terminal.terminal() as term:
+                while date is None:
+                    date = str(term.input("Enter date(YYYY-MM-DD), leave blank for today: ")).strip()
+                    if len(date) == 0:
+                        break
+                    try:
+                        datetime.datetime.strptime(date, "%Y-%m-%d")
+                    except ValueError:
+                        term.print("Malformed date\n")
+                        date = None
+
+                if len(shared_tags) == 0:
+                    shared_tags = str(term.input("Enter tags shared by all entries(comma separated): ")).strip()
+                    shared_tags = [tag.strip() for tag in shared_tags.split(",") if len(tag.strip()) != 0]
+
+                while True:
+                    name = str(term.input("Enter entry name, leave blank if finished: ", self._tabcomplete_name())).strip()
+                    if len(name) == 0:
+                        break
+
+                    try:
+                        new_entry = self._input_food(term, name)
+                    except (SyntaxError, TypeError, ValueError, ZeroDivisionError):
+                        # a malformed value only skips this entry
+                        term.print("Malformed value, \"" + name + "\" was not added.\n")
+                        continue
+
+                    new_entry.tags = new_entry._tags + [tag for tag in shared_tags if tag not in new_entry._tags]
+                    if len(date) != 0:
+                        new_entry.timestamp = date
+
+                    database.add_entry(new_entry)
+                    unsaved += 1
+                    if unsaved >= self._checkpoint_interval:
+                        database.update(backup=backup)
+                        unsaved = 0
+                        backup = False
+        finally:
+            if unsaved != 0:
+                database.update(backup=backup)
+
+    def _input_food(self, term, name=None, tags=None):
+        """Prompt for the details of a food entry.
+
+        Parameters
+        ----------
+        term : terminal.terminal
+            Open terminal session to prompt in.
+        name : string, optional
+            Name of the entry. If None the user is prompted for it. The default is None
+        tags : list, optional
+            Tags of the entry. If None the user is prompted for them. The default is None
+
+        Returns
+        -------
+        groceryDatabase.entry
+            The new entry.
+        """
+        attributes = []
+
+        while name is None:
+            name = str(term.input("Enter entry name: ", self._tabcomplete_name())).strip()
+            if len(name) == 0:
+                name = None
+
+        if tags is None:
+            tags = str(term.input("Enter tags(comma separated): ", self._tabcomplete_tag(name))).strip()
+            tags = [tag.strip() for tag in tags.split(",") if len(tag.strip()) != 0]
+
+        attributes.append(("price", self._float_eval(term.input("Enter price: ", self._tabcomplete_attribute(name, tags, "price"))), "dollars"))
+
+        while True:
+            reply = str(term.input("Did you buy more than one[y/n]: ")).lower()
+            if reply.startswith("y"):
+                attributes.append(("quantity", self._float_eval(term.input("Enter quantity: ", self._tabcomplete_attribute(name, tags, "quantity"))), None))
+                break
+            elif reply.startswith("n"):
+                break
+
+        while True:
+            reply = str(term.input("Mesure by mass or volume[m/v]: ")).lower()
+            if reply.startswith("m"):
+                attributes.append(("mass", self._float_eval(term.input("Enter mass in grams: ", self._tabcomplete_attribute(name, tags, "mass"))), "g"))
+                break
+            elif reply.startswith("v"):
+                attributes.append(("volume", self._float_eval(term.input("Enter volume in milliliters: ", self._tabcomplete_attribute(name, tags, "volume"))), "ml"))
+                break
+            elif reply.strip() == "":
+                # skip if empty
+                break
+
+        try:
+            attributes.append(("calories", self._float_eval(term.input("Enter calories in calories per 100 grams: ", self._tabcomplete_attribute(name, tags, "calories"))), "calories/100g"))
+        except:
+            pass # skip if empty
 
-            attributes.append(("price", self._float_eval(term.input("Enter price: ", self._tabcomplete_attribute(name, tags, "price"))), "dollars"))
-
-            while True:
-                reply = str(term.input("Did you buy more than one[y/n]: ")).lower()
-                if reply.startswith("y"):
-                    attributes.append(("quantity", self._float_eval(term.input("Enter quantity: ", self._tabcomplete_attribute(name, tags, "quantity"))), None))
-                    break
-                elif reply.startswith("n"):
-                    break
-
-            while True:
-                reply = str(term.input("Mesure by mass or volume[m/v]: ")).lower()
-                if reply.startswith("m"):
-                    attributes.append(("mass", self._float_eval(term.input("Enter mass in grams: ", self._tabcomplete_attribute(name, tags, "mass"))), "g"))
-                    break
-                elif reply.startswith("v"):
-                    attributes.append(("volume", self._float_eval(term.input("Enter volume in milliliters: ", self._tabcomplete_attribute(name, tags, "volume"))), "ml"))
-                    break
-                elif reply.strip() == "":
-                    # skip if empty
-                    break
-
-            try:
-                attributes.append(("calories", self._float_eval(term.input("Enter calories in calories per 100 grams: ", self._tabcomplete_attribute(name, tags, "calories"))), "calories/100g"))
-            except:
-                pass # skip if empty
-
-            try:
-                attributes.append(("fat", self._float_eval(term.input("Enter fat in grams per 100 grams: ", self._tabcomplete_attribute(name, tags, "fat"))), "g/100g"))
-            except:
-                pass
-
-            try:
-                attributes.append(("carbohydrates", self._float_eval(term.input("Enter carbohydrates in grams per 100 grams: ", self._tabcomplete_attribute(name, tags, "carbohydrates"))), "g/100g"))
-            except:
-                pass
-
-            try:
-                attributes.append(("protein", self._float_eval(term.input("Enter protein in grams per 100 grams: ", self._tabcomplete_attribute(name, tags, "protein"))), "g/100g"))
-            except:
-                pass
+        try:
+            attributes.append(("fat", self._float_eval(term.input("Enter fat in grams per 100 grams: ", self._tabcomplete_attribute(name, tags, "fat"))), "g/100g"))
+        except:
+            pass
+
+        try:
+            attributes.append(("carbohydrates", self._float_eval(term.input("Enter carbohydrates in grams per 100 grams: ", self._tabcomplete_attribute(name, tags, "carbohydrates"))), "g/100g"))
+        except:
+            pass
+
+        try:
+            attributes.append(("protein", self._float_eval(term.input("Enter protein in grams per 100 grams: ", self._tabcomplete_attribute(name, tags, "protein"))), "g/100g"))
+        except:
+            pass
 
         new_entry = groceryDatabase.entry(name, tags)
         for name, value, unit in attributes:
             new_attribute = groceryDatabase.attribute(name, value, unit)
             new_entry.add_attribute(new_attribute)
 
-        self.database.add_entry(new_entry)
-        self.database.update()
+        return new_entry
+
+    @command
+    def stats(self, arg):
+        """Display spending and nutrition totals for the current period.
+
+        The period is one of daily, weekly or monthly. If a tag is given
+        only entries with that tag are included.
+
+        Examples:
+            stats period tag
+            stats period
+            stats
+        """
+        arg = arg.split(None, 1)
+        period = "weekly"
+        tag = None
+        if len(arg) > 0:
+            period = arg[0].strip()
+        if len(arg) > 1:
+            tag = arg[1].strip()
+
+        if period not in groceryDatabase._periods:
+            print("\"" + period + "\" is not a valid period. Use one of " + ", ".join(groceryDatabase._periods) + ".")
+            return
+
+        # only load the database if the saved aggregates are out of date
+        totals = groceryDatabase.cached_stats(period, tag)
+        if totals is None:
+            totals = self.database.stats(period, tag)
+        units = {"price":"dollars", "mass":"g", "calories":"calories", "fat":"g", "carbohydrates":"g", "protein":"g"}
+
+        text = "Stats: " + period
+        if tag is not None:
+            text = text + " [" + tag + "]"
+        print(text)
+        for field, value in totals.items():
+            print(field + ": " + "{:.2f}".format(value) + " " + units[field])
+
+        if totals["price"] > 0:
+            print("protein per dollar: " + "{:.2f}".format(totals["protein"]/totals["price"]) + " g/dollars")
+
+    @command
+    def search(self, arg):
+        """Search the entry names and tags.
+
+        Results are ranked by similarity, so misspelled names and names
+        with the words in a different order are still found.
+
+        Examples:
+            search milk 2%
+        """
+        if len(arg.strip()) == 0:
+            print("Nothing to search for. See 'gdata help search'")
+            return
+
+        for term, score in self.database.search(arg):
+            text = "{:.2f}".format(score) + " " + term
+            if term not in self.database._names:
+                text = text + " (tag)"
+            print(text)
+
+    @command
+    def completion(self, arg):
+        """Print the shell completion script for bash or zsh.
+
+        Load it from your shell startup file, for example by adding
+        eval "$(gdata completion bash)" to ~/.bashrc.
+
+        Examples:
+            completion bash
+            completion zsh
+        """
+        shell = arg.strip()
+        if shell not in ["bash", "zsh"]:
+            print("\"" + shell + "\" is not a supported shell. Use bash or zsh.")
+            return
+
+        program = os.path.basename(sys.argv[0])
+        script = ""
+        if shell == "zsh":
+            script = "autoload -U +X bashcompinit && bashcompinit\n"
+
+        script = script + "_gdata_complete() {\n"
+        script = script + "    local IFS=$'\\n'\n"
+        script = script + "    COMPREPLY=($(\"${COMP_WORDS[0]}\" complete \"${COMP_LINE:0:$COMP_POINT}\"))\n"
+        script = script + "}\n"
+        script = script + "complete -F _gdata_complete " + program
+        print(script)
+
+    @command
+    def complete(self, arg):
+        """Print the completions of a partial command line.
+
+        Used by the shell completion script, see 'gdata help completion'.
+        Product names and tags are read from the completion cache written
+        when the database is saved.
+
+        Examples:
+            complete gdata add name, tag
+        """
+        # words are separated by unescaped spaces
+        words = arg.replace("\\ ", "\0").split(" ")
+        word = words[-1].replace("\0", "\\ ")
+        options = []
+        string = ""
+
+        if len(words) == 2:
+            string = words[1]
+            options = [name for name in _commands if name.startswith(string)]
+        elif len(words) > 2:
+            text = " ".join(words[2:]).replace("\0", " ")
+            if words[1] == "help" and len(words) == 3:
+                string = text
+                options = [name for name in _commands if name.startswith(string)]
+            elif words[1] == "completion" and len(words) == 3:
+                string = text
+                options = [shell for shell in ["bash", "zsh"] if shell.startswith(string)]
+            elif words[1] == "stats":
+                if len(words) == 3:
+                    string = text
+                    options = [period for period in groceryDatabase._periods if period.startswith(string)]
+                else:
+                    data = groceryDatabase.completion_cache()
+                    string = " ".join(words[3:]).replace("\0", " ")
+                    tags = set(data["names"])
+                    for name in data["names"]:
+                        tags.update(data["tags"][name])
+                    options = sorted(tag for tag in tags if tag.startswith(string))
+            elif words[1] in ["add", "add_custom"] and ":" not in text:
+                if words[1] == "add" and text.startswith("--session "):
+                    text = text[len("--session "):]
+
+                data = groceryDatabase.completion_cache()
+                if "," in text:
+                    name = text.split(",")[0].strip()
+                    string = text.split(",")[-1].lstrip()
+                    options = _tag_candidates(data, name, string)
+                else:
+                    string = text.lstrip()
+                    options = _name_candidates(data, string)
+                    if (words[1] == "add") and (len(words) == 3) and "--session".startswith(string):
+                        options = ["--session"] + options
+
+        for option in options:
+            print(word + option[len(string):].replace(" ", "\\ "))
 
     @command
     def help(self, arg):
@@ -234,6 +590,7 @@ class gdatabaseUtility:
         else:
             if arg.strip() in _commands:
                 if _commands[arg.strip()] is not None:
+                    import textwrap
                     print(textwrap.dedent(_commands[arg.strip()]))
                 else:
                     print("No documentation exists for the subcommand \"" + arg.strip() + "\".")
@@ -244,29 +601,13 @@ class gdatabaseUtility:
         """returns callback function for tab completion
         """
         def tabcomplete(string):
-            names = []
-            for entry in self.database._database:
-                if entry.name.startswith(string):
-                    names.append(entry.name)
-            names = list(set(names))
-
-            prefix = os.path.commonprefix(names)
-
-            text = ""
-            if len(prefix) != 0:
-                text = prefix[len(string):]
-
-            tips = ""
-            if len(names) > 1:
-                for i, name in enumerate(names[:-1]):
-                    tips = tips + name
-                    if (i + 1)%3 == 0:
-                        tips = tips + "\n"
-                    else:
-                        tips = tips + ", "
-
-                tips = tips + names[-1]
-            return text, tips
+            names = _name_candidates(self.database.completion_data(), string)
+            if (len(names) == 0) and (len(string.strip()) != 0):
+                # no exact prefix, suggest similar names
+                names = [name for name, score in self.database.search(string, names_only=True)]
+                if len(names) != 0:
+                    return "", _tabcomplete_tips(names)
+            return _tabcomplete_text(names, string)
         return tabcomplete
 
     def _tabcomplete_tag(self, name):
@@ -276,31 +617,8 @@ class gdatabaseUtility:
             if "," in string:
                 string = string.split(",")[-1].strip()
 
-            tags = []
-            for entry in self.database._database:
-                if entry.name == name:
-                    for tag in entry._tags:
-                        if tag.startswith(string):
-                            tags.append(tag)
-            tags = list(set(tags))
-
-            prefix = os.path.commonprefix(tags)
-
-            text = ""
-            if len(prefix) != 0:
-                text = prefix[len(string):]
-
-            tips = ""
-            if len(tags) > 1:
-                for i, tag in enumerate(tags[:-1]):
-                    tips = tips + tag
-                    if (i + 1)%3 == 0:
-                        tips = tips + "\n"
-                    else:
-                        tips = tips + ", "
-
-                tips = tips + tags[-1]
-            return text, tips
+            tags = _tag_candidates(self.database.completion_data(), name, string)
+            return _tabcomplete_text(tags, string)
         return tabcomplete
 
     def _tabcomplete_attribute(self, name, tags, attribute):
@@ -315,25 +633,8 @@ class gdatabaseUtility:
                             if trait.name == attribute:
                                 if str(trait.value).startswith(string):
                                     values.append("{:.2f}".format(trait.value))
-            values = list(set(values))
-
-            prefix = os.path.commonprefix(values)
-
-            text = ""
-            if len(prefix) != 0:
-                text = prefix[len(string):]
-
-            tips = ""
-            if len(values) > 1:
-                for i, value in enumerate(values[:-1]):
-                    tips = tips + value
-                    if (i + 1)%3 == 0:
-                        tips = tips + "\n"
-                    else:
-                        tips = tips + ", "
-
-                tips = tips + values[-1]
-            return text, tips
+            values = sorted(set(values))
+            return _tabcomplete_text(values, string)
         return tabcomplete
 
     def _float_eval(self, string):
@@ -3,8 +3,14 @@
 
 import os
 import time
+import heapq
+import bisect
+import marshal
 import datetime
-import configparser
+import threading
+
+# json, configparser and concurrent.futures are imported where they are used
+# to keep the startup of gdata fast
 
 class attribute:
     """Attribute of an entry in the database
@@ -138,35 +144,44 @@ class entry:
     def tags(self, tags):
         self._tags = tags
 
+_dir = os.path.dirname(os.path.abspath(__file__))
+_config_path = _dir + "/.groceryDatabase.conf"
+
+_periods = {"daily":"%Y-%m-%d", "weekly":"%G-W%V", "monthly":"%Y-%m"}
+_aggregate_fields = ["price", "mass", "calories", "fat", "carbohydrates", "protein"]
+
 class groceryDatabase:
     """Object maintaining a list of entry instances.
     """
 
     def __init__(self):
-        self._dir = os.path.dirname(os.path.abspath(__file__))
-        self._config_path = self._dir + "/.groceryDatabase.conf"
+        self._dir = _dir
+        self._config_path = _config_path
 
         self._path = ""
         self._backup_dir = ""
         self._backup_interval = 0
+        self._load_workers = 1
 
         self._timestamp = 0
         self._database = []
-
-        config = configparser.ConfigParser()
-        config.read(self._config_path)
+        self._aggregates = {period:{} for period in _periods}
+        self._index = None
+        self._ngrams = {}
+        self._names = set()
+        self._index_lock = threading.Lock()
+        self._completion = None
 
         try:
-            self._load_from_config(config)
+            self._load_from_config(_read_config(self._config_path))
         except KeyError:
             print("WARNING: Broken or missing configfile \"" + self._config_path + "\". Initalizing new config file.")
             self._broken_config_file()
 
-            config.read(self._config_path)
-            self._load_from_config(config)
+            self._load_from_config(_read_config(self._config_path))
 
         try:
-            self.load()
+            self.load(self._load_workers)
         except FileNotFoundError:
             print("WARNING: No database found at \"" + self._path + "\". Initalizing new database file.")
             self.update(backup=False)
@@ -182,9 +197,8 @@ class groceryDatabase:
         """
         self._timestamp = int(time.time())
 
-        if backup:
-            old_database = groceryDatabase()
-            if abs(self._timestamp - old_database._timestamp) > self._backup_interval:
+        if backup and os.path.exists(self._path):
+            if abs(self._timestamp - _read_timestamp(self._path)) > self._backup_interval:
                 backup_dir = os.path.dirname(self._path) + self._backup_dir
                 if not os.path.exists(backup_dir):
                     os.makedirs(backup_dir)
@@ -197,8 +211,19 @@ class groceryDatabase:
         with open(self._path, "w") as fout:
             fout.write(str(self._timestamp) + "\n" +repr(self))
 
-    def load(self):
+        self._write_aggregates()
+        self._write_completion_cache()
+
+    def load(self, workers=1):
         """Load database from file
+
+        Parameters
+        ----------
+        workers : integer, optional
+            Number of processes used to parse the database. If greater than
+            one the file is split at block boundaries and the chunks are
+            parsed in parallel. It is limited to the number of CPUs. The
+            default is 1
         """
         self._database = []
 
@@ -207,16 +232,21 @@ class groceryDatabase:
             text = fin.read()
 
         lines = text.split("\n")
-        start = 0
-        end = 0
-        while True:
-            try:
-                start, end = self._find_block(lines, end)
-                new_entry = entry(name=None)
-                new_entry._update_from_text(lines[start:end])
-                self.add_entry(new_entry)
-            except EOFError:
-                break
+        workers = min(workers, os.cpu_count() or 1)
+        if workers > 1:
+            import concurrent.futures
+            chunks = _split_blocks(lines, workers)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_parse_blocks, chunks))
+
+            # entry._counter is only updated inside the worker processes
+            for entries in results:
+                for new_entry in entries:
+                    if new_entry.id >= entry._counter:
+                        entry._counter = new_entry.id + 1
+                self._database.extend(entries)
+        else:
+            self._database = _parse_blocks(lines)
 
         try:
             if len(lines) != 0:
@@ -225,6 +255,60 @@ class groceryDatabase:
             print("Warning: No database time stamp found.")
             self._timestamp = 1
 
+        with self._index_lock:
+            self._index = None
+        self._load_aggregates()
+
+        self._completion = None
+        if _read_completion_cache(self._path).get("timestamp") != self._timestamp:
+            self._write_completion_cache()
+
+    def completion_data(self):
+        """Get the names and tags used for completion
+
+        The data is built on first use and then kept up to date by
+        add_entry.
+
+        Returns
+        -------
+        dict
+            "names" is a sorted list of the entry names and "tags" maps
+            each name to a sorted list of its tags.
+        """
+        if self._completion is None:
+            tags = {}
+            for entry in self._database:
+                tags.setdefault(entry.name, set()).update(entry._tags)
+
+            self._completion = {"names":sorted(tags), "tags":{name:sorted(tags[name]) for name in tags}}
+        return self._completion
+
+    def _complete_entry(self, entry):
+        """Add the name and tags of entry to the completion data
+
+        Parameters
+        ----------
+        entry : entry
+            Entry to include in the completion data.
+        """
+        if entry.name not in self._completion["tags"]:
+            bisect.insort(self._completion["names"], entry.name)
+            self._completion["tags"][entry.name] = []
+
+        tags = self._completion["tags"][entry.name]
+        for tag in entry._tags:
+            position = bisect.bisect_left(tags, tag)
+            if (position == len(tags)) or (tags[position] != tag):
+                tags.insert(position, tag)
+
+    def _write_completion_cache(self):
+        """Save the completion data next to the database for shell completion.
+        """
+        data = {"timestamp":self._timestamp}
+        data.update(self.completion_data())
+        with open(self._path + ".complete", "wb") as fout:
+            marshal.dump(data, fout)
+
     def add_entry(self, entry):
         """Add entry to database
 
@@ -234,8 +318,142 @@ class groceryDatabase:
             Add entry to data base
         """
         self._database = self._database + [entry]
+        self._aggregate_entry(entry)
+        with self._index_lock:
+            if self._index is not None:
+                _index_entry(entry, self._index, self._ngrams, self._names)
+        if self._completion is not None:
+            self._complete_entry(entry)
+
+    def search(self, query, limit=10, names_only=False):
+        """Find the entry names and tags most similar to a query
+
+        Names and tags are compared by the trigrams of their words, so
+        results are found despite typos or a different word order.
+        The search index is built on the first search. Searches may run
+        in other threads, for example during tab completion.
+
+        Parameters
+        ----------
+        query : string
+            The text to search for.
+        limit : integer, optional
+            Maximum number of results. The default is 10
+        names_only : bool, optional
+            If True tags that are not an entry name are not included. The
+            default is False
+
+        Returns
+        -------
+        list
+            List of (term, score) tuples with the best match first. The score
+            is between 0 and 1.
+        """
+        ngrams = _ngrams(query)
+
+        with self._index_lock:
+            if self._index is None:
+                # only publish the index once it is complete
+                index, term_ngrams, names = {}, {}, set()
+                for entry in self._database:
+                    _index_entry(entry, index, term_ngrams, names)
+                self._index, self._ngrams, self._names = index, term_ngrams, names
+
+            counts = {}
+            for ngram in ngrams:
+                for term in self._index.get(ngram, ()):
+                    counts[term] = counts.get(term, 0) + 1
+
+            results = []
+            for term, count in counts.items():
+                if names_only and (term not in self._names):
+                    continue
+                results.append((-2*count/(len(ngrams) + len(self._ngrams[term])), term))
+
+        return [(term, -score) for score, term in heapq.nsmallest(limit, results)]
+
+    def stats(self, period="weekly", tag=None, date=None):
+        """Get the aggregate totals of a period
+
+        Parameters
+        ----------
+        period : string, optional
+            One of "daily", "weekly" or "monthly". The default is "weekly"
+        tag : string, optional
+            Only include entries with this tag. If None all entries are
+            included. The default is None
+        date : string, optional
+            A date "%Y-%m-%d" in the period. If None the current date is
+            used. The default is None
+
+        Returns
+        -------
+        dict
+            The sum of price and mass, and the calories and macros weighted
+            by mass, of the entries in the period.
+        """
+        return _period_totals(self._aggregates, period, tag, date)
+
+    def _aggregate_entry(self, entry):
+        """Add entry to the daily, weekly and monthly aggregates
+
+        Parameters
+        ----------
+        entry : entry
+            Entry to include in the aggregates.
+        """
+        values = {trait.name:trait.value for trait in entry.attributes}
 
-    def _find_block(self, lines, offset=0):
+        amounts = {}
+        for field in ["price", "mass"]:
+            if field in values:
+                amounts[field] = values[field]
+
+        # calories and macros are stored per 100 grams
+        if "mass" in values:
+            for field in ["calories", "fat", "carbohydrates", "protein"]:
+                if field in values:
+                    amounts[field] = values[field]*values["mass"]/100
+
+        try:
+            date = datetime.datetime.strptime(entry.timestamp, "%Y-%m-%d")
+        except ValueError:
+            print("Warning: Malformed timestamp \"" + entry.timestamp + "\" in entry " + str(entry.id) + ", it is not included in the stats.")
+            return
+
+        for period, key_format in _periods.items():
+            buckets = self._aggregates[period].setdefault(date.strftime(key_format), {})
+            for tag in [""] + list(set(entry.tags)):
+                totals = buckets.setdefault(tag, {})
+                for field, amount in amounts.items():
+                    totals[field] = totals.get(field, 0.0) + amount
+
+    def _load_aggregates(self):
+        """Load aggregates from file, rebuild them if they are missing or stale.
+        """
+        import json
+        try:
+            with open(self._path + ".stats", "r") as fin:
+                data = json.load(fin)
+
+            if data["timestamp"] != self._timestamp:
+                raise ValueError
+            self._aggregates = data["aggregates"]
+        except (FileNotFoundError, ValueError, KeyError):
+            self._aggregates = {period:{} for period in _periods}
+            for entry in self._database:
+                self._aggregate_entry(entry)
+            self._write_aggregates()
+
+    def _write_aggregates(self):
+        """Save the aggregates next to the database.
+        """
+        import json
+        with open(self._path + ".stats", "w") as fout:
+            json.dump({"timestamp":self._timestamp, "aggregates":self._aggregates}, fout)
+
+    @staticmethod
+    def _find_block(lines, offset=0):
         """Find index of block
 
         Parameters
@@ -261,14 +479,15 @@ class groceryDatabase:
         start = None
         stop = None
         isblock = False
-        for i, line in enumerate(lines[offset:]):
+        for i in range(offset, len(lines)):
+            line = lines[i]
             if isblock:
                 if line.startswith("[/"):
-                    stop = i + 1 + offset
+                    stop = i + 1
                     return start, stop
             else:
                 if line.startswith("[") and (not line.startswith("[/")):
-                    start = i + offset
+                    start = i
                     isblock = True
 
         if isblock:
@@ -282,14 +501,287 @@ class groceryDatabase:
         self._path = config["main"]["database_path"]
         self._backup_dir = config["main"]["backup_dir"]
         self._backup_interval = int(config["main"]["backup_interval"])
+        # optional, config files written before it was added do not have it
+        self._load_workers = int(config["main"].get("load_workers", "1"))
 
     def _broken_config_file(self):
         """Overwrite broken or missing config file.
         """
+        import configparser
         config = configparser.ConfigParser()
         config["main"] = {}
         config["main"]["database_path"] = self._dir + "/database_grocery.db"
         config["main"]["backup_dir"] = "/backups"
         config["main"]["backup_interval"] = "86400"
+        config["main"]["load_workers"] = "1"
         with open(self._config_path, "w") as fout:
             config.write(fout)
+
+def completion_cache():
+    """Read the completion data saved by the last update of the database
+
+    The database itself is not read.
+
+    Returns
+    -------
+    dict
+        The completion data, see groceryDatabase.completion_data. If the
+        completion cache is missing or older than the database it has no
+        names or tags.
+    """
+    try:
+        path = _read_config(_config_path)["main"]["database_path"]
+        data = _read_completion_cache(path)
+        if data.get("timestamp") == _read_timestamp(path):
+            return data
+    except (KeyError, OSError):
+        pass
+    return {"names":[], "tags":{}}
+
+def _read_completion_cache(path):
+    """Read the completion cache of a database
+
+    Parameters
+    ----------
+    path : string
+        Path of the database file.
+
+    Returns
+    -------
+    dict
+        The saved completion data and the time stamp of the database it
+        was made from. Empty if there is no readable completion cache.
+    """
+    try:
+        with open(path + ".complete", "rb") as fin:
+            data = marshal.load(fin)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+
+    if not isinstance(data, dict):
+        return {}
+    return data
+
+def _index_entry(entry, index, ngrams, names):
+    """Add the name and tags of entry to a search index
+
+    Parameters
+    ----------
+    entry : entry
+        Entry to include in the search index.
+    index : dict
+        Maps each trigram to the set of terms containing it.
+    ngrams : dict
+        Maps each indexed term to its trigrams.
+    names : set
+        The entry names in the index.
+    """
+    names.add(entry.name)
+    for term in entry.tags:
+        if term not in ngrams:
+            ngrams[term] = _ngrams(term)
+            for ngram in ngrams[term]:
+                index.setdefault(ngram, set()).add(term)
+
+def _ngrams(text):
+    """Get the trigrams of the words in text
+
+    Parameters
+    ----------
+    text : string
+        Text to split into trigrams.
+
+    Returns
+    -------
+    frozenset
+        The trigrams of each word in text, padded with spaces so that words
+        shorter than three characters are included.
+    """
+    ngrams = set()
+    for word in text.lower().split():
+        word = " " + word + " "
+        for i in range(len(word) - 2):
+            ngrams.add(word[i:i + 3])
+    return frozenset(ngrams)
+
+def cached_stats(period="weekly", tag=None, date=None):
+    """Get the aggregate totals of a period without loading the database
+
+    Parameters
+    ----------
+    period : string, optional
+        One of "daily", "weekly" or "monthly". The default is "weekly"
+    tag : string, optional
+        Only include entries with this tag. If None all entries are
+        included. The default is None
+    date : string, optional
+        A date "%Y-%m-%d" in the period. If None the current date is
+        used. The default is None
+
+    Returns
+    -------
+    dict
+        The totals, see groceryDatabase.stats. None if the saved aggregates
+        are missing or older than the database.
+    """
+    import json
+    try:
+        path = _read_config(_config_path)["main"]["database_path"]
+        with open(path + ".stats", "r") as fin:
+            data = json.load(fin)
+
+        if data["timestamp"] != _read_timestamp(path):
+            return None
+        return _period_totals(data["aggregates"], period, tag, date)
+    except (KeyError, OSError, ValueError):
+        return None
+
+def _period_totals(aggregates, period, tag=None, date=None):
+    """Look up the totals of a period in the aggregates
+
+    Parameters
+    ----------
+    aggregates : dict
+        The aggregates of a database.
+    period : string
+        One of "daily", "weekly" or "monthly".
+    tag : string, optional
+        Only include entries with this tag. If None all entries are
+        included. The default is None
+    date : string, optional
+        A date "%Y-%m-%d" in the period. If None the current date is
+        used. The default is None
+
+    Returns
+    -------
+    dict
+        The totals of each aggregated field.
+    """
+    if date is None:
+        date = datetime.datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d")
+
+    key = datetime.datetime.strptime(date, "%Y-%m-%d").strftime(_periods[period])
+    if tag is None:
+        tag = ""
+
+    totals = {field:0.0 for field in _aggregate_fields}
+    totals.update(aggregates[period].get(key, {}).get(tag, {}))
+    return totals
+
+def _read_timestamp(path):
+    """Read the time stamp of a database file without loading it.
+
+    Parameters
+    ----------
+    path : string
+        Path of the database file.
+
+    Returns
+    -------
+    integer
+        The time the database file was last saved.
+    """
+    with open(path, "r") as fin:
+        try:
+            return int(fin.readline())
+        except ValueError:
+            return 1
+
+def _read_config(path):
+    """Read a config file
+
+    The parsed config is cached next to the config file and reused for as
+    long as the config file is unchanged.
+
+    Parameters
+    ----------
+    path : string
+        Path of the config file.
+
+    Returns
+    -------
+    dict
+        The values of each section of the config file. If the config file
+        does not exist it is empty.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    try:
+        with open(path + ".cache", "rb") as fin:
+            cached_key, config = marshal.load(fin)
+        if tuple(cached_key) == key:
+            return config
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    import configparser
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    config = {section:dict(parser[section]) for section in parser.sections()}
+
+    try:
+        with open(path + ".cache", "wb") as fout:
+            marshal.dump((key, config), fout)
+    except OSError:
+        pass
+    return config
+
+def _parse_blocks(lines):
+    """Parse all entries in a list of lines
+
+    Parameters
+    ----------
+    lines : list
+        A list of the lines of text contained in the database.
+
+    Returns
+    -------
+    list
+        The entries in the order they appear in lines.
+    """
+    entries = []
+    end = 0
+    while True:
+        try:
+            start, end = groceryDatabase._find_block(lines, end)
+        except EOFError:
+            break
+
+        new_entry = entry(name=None)
+        new_entry._update_from_text(lines[start:end])
+        entries.append(new_entry)
+    return entries
+
+def _split_blocks(lines, number):
+    """Split lines into chunks at block boundaries
+
+    Parameters
+    ----------
+    lines : list
+        A list of the lines of text contained in the database.
+    number : integer
+        Number of chunks to split the lines into.
+
+    Returns
+    -------
+    list
+        List of at most number chunks, each a list of lines containing
+        only complete blocks.
+    """
+    boundaries = [i + 1 for i, line in enumerate(lines) if line.startswith("[/")]
+    if len(boundaries) == 0:
+        return [lines]
+
+    size = -(-len(boundaries)//number)
+    ends = boundaries[size - 1:-1:size] + [len(lines)]
+
+    chunks = []
+    start = 0
+    for end in ends:
+        chunks.append(lines[start:end])
+        start = end
+    return chunks
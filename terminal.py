@@ -3,18 +3,58 @@
 manage terminal session
 """
 
+import time
 import curses
+import threading
+
+class _completion(threading.Thread):
+    """Run a tab completion callback in a background thread
+
+    Parameters
+    ----------
+    tabcomplete : function(string)
+        The callback for tab completion.
+    string : string
+        The string to complete.
+    """
+
+    def __init__(self, tabcomplete, string):
+        super().__init__(daemon=True)
+        self.tabcomplete = tabcomplete
+        self.string = string
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.tabcomplete(self.string)
+        except Exception as error:
+            self.error = error
 
 class terminal:
     def __init__(self):
         self.stdscr = None
+        self.keys = None
         self.insert = False
+        self.job = None # running tab completion
+
+        # seconds to wait after tab before completing and between checks
+        # on a running completion
+        self.debounce = 0.1
+        self.poll = 0.02
 
     def __enter__(self):
         self.stdscr = curses.initscr()
         curses.cbreak()
         self.stdscr.keypad(True)
+        self.stdscr.scrollok(True)
         curses.noecho()
+
+        # getkey refreshes the window it reads from if it was changed, so
+        # keys are read from a window that is never drawn to
+        self.keys = curses.newwin(1, 1, 0, 0)
+        self.keys.keypad(True)
+        self.keys.untouchwin()
         return self
 
     def __exit__(self, *args):
@@ -72,6 +112,11 @@ class terminal:
     def input(self, prompt, tabcomplete=None):
         """Get user input
 
+        Screen updates are batched and only drawn once there is no pending
+        input. Tab completion runs in a background thread after a short
+        delay, its result is discarded if another key is pressed first. Only
+        one completion runs at a time, a new one waits for the last to end.
+
         Parameters
         ----------
         prompt : sting
@@ -86,83 +131,215 @@ class terminal:
         """
         # print prompt
         self.stdscr.addstr(prompt)
-        self.stdscr.refresh()
+        self._refresh()
 
         # get reply
         string = ""
         index = 0
+        dirty = False
+        pending = None # time to start tab completion
+        wanted = False # if the result of self.job is still wanted
         while True:
-            key = self.stdscr.getkey()
+            if dirty:
+                key = self._getkey(0)
+            elif (pending is not None) or (self.job is not None):
+                key = self._getkey(self.poll)
+            else:
+                key = self._getkey(None)
+
+            if key is None: # no input waiting
+                if dirty:
+                    self._refresh()
+                    dirty = False
+                elif (self.job is not None) and (not self.job.is_alive()):
+                    job = self.job
+                    self.job = None
+                    if wanted:
+                        wanted = False
+                        if job.error is not None:
+                            raise job.error
+                        string, index = self._complete(string, index, *job.result)
+                        dirty = True
+                elif (pending is not None) and (self.job is None) and (time.monotonic() >= pending):
+                    pending = None
+                    wanted = True
+                    self.job = _completion(tabcomplete, string)
+                    self.job.start()
+                continue
+
+            # any key press discards the result of tab completion
+            pending = None
+            wanted = False
+
+            dirty = True
             if not key.startswith("KEY_"): # if not special key
                 if key not in ["\n", "\t"]: # if not tab or enter
                     # add or insert key to string
-                    self.stdscr.addstr(key)
                     if index > len(string) - 1:
+                        self.stdscr.addstr(key)
                         string = string + key
                     else:
                         if self.insert:
                             string = string[:index] + key + string[index:]
-                            y, x = self.stdscr.getyx()
-                            self.stdscr.addstr(y, x, string[index + 1:])
-                            self.stdscr.move(y, x)
+                            self._insert(key, string[index:])
                         else:
+                            self.stdscr.addstr(key)
                             string = string[:index] + key + string[index + 1:]
                     index += 1
                 elif key == "\t": # auto complete
                     if tabcomplete is not None:
-                        text, tips = tabcomplete(string)
-                        y, x = self.stdscr.getyx()
-                        self.stdscr.move(y + 1, 0)
-                        self.stdscr.clrtobot()
-                        self.stdscr.move(y, x)
-
-                        if len(text) != 0:
-                            string = string[:index] + text + string[index:]
-                            y, x = self.stdscr.getyx()
-                            self.stdscr.addstr(y, x, string[index:])
-                            self.stdscr.move(y, x + len(text))
-                            index = index + len(text)
-                        else:
-                            y, x = self.stdscr.getyx()
-                            self.stdscr.addstr(y + 1, 0, tips)
-                            self.stdscr.move(y, x)
+                        pending = time.monotonic() + self.debounce
                 else: # save input and move to next line
-                    y, x = self.stdscr.getyx()
-                    self.stdscr.move(y + 1, 0)
+                    self._move(len(string) - index)
+                    self.stdscr.addstr("\n") # scroll if on the last line
+                    self._refresh()
                     break
             elif key == "KEY_BACKSPACE": # remove character before cursor
                 if index > 0:
-                    if index > len(string) - 1:
-                        string = string[:-1]
-                        index -= 1
-                        y, x = self.stdscr.getyx()
-                        self.stdscr.addstr(y, x - 1, " ")
-                        self.stdscr.move(y, x - 1)
-                    else:
-                        string = string[:index - 1] + string[index:]
-                        index -= 1
-                        y, x = self.stdscr.getyx()
-                        x -= 1
-                        self.stdscr.addstr(y, x + (len(string) - index), " ")
-                        self.stdscr.addstr(y, x, string[index:])
-                        self.stdscr.move(y, x)
+                    string = string[:index - 1] + string[index:]
+                    index -= 1
+                    self._move(-1)
+                    self._delete(string[index:])
             elif key == "KEY_DC": # remove character under curser
                 if index < len(string):
                     string = string[:index] + string[index + 1:]
-                    y, x = self.stdscr.getyx()
-                    self.stdscr.addstr(y, x + (len(string) - index), " ")
-                    self.stdscr.addstr(y, x, string[index:])
-                    self.stdscr.move(y, x)
+                    self._delete(string[index:])
             elif key == "KEY_IC": # change insert mode
                 self.insert = not self.insert
             elif key == "KEY_LEFT": # move cursor
                 if index > 0:
                     index -= 1
-                    y, x = self.stdscr.getyx()
-                    self.stdscr.move(y, x - 1)
+                    self._move(-1)
             elif key == "KEY_RIGHT": # move cursor
                 if index < len(string):
                     index += 1
-                    y, x = self.stdscr.getyx()
-                    self.stdscr.move(y, x + 1)
+                    self._move(1)
         return string
+
+    def _complete(self, string, index, text, tips):
+        """Apply the result of tab completion
+
+        Parameters
+        ----------
+        string : string
+            The current user input string
+        index : integer
+            The cursor position in string
+        text : string
+            Text to insert at the cursor
+        tips : string
+            Possible completions to display below the input
+
+        Returns
+        -------
+        string
+            The updated user input string
+        integer
+            The updated cursor position
+        """
+        # clear old tips below the end of the input
+        y, x = self.stdscr.getyx()
+        self._move(len(string) - index)
+        end_y, end_x = self.stdscr.getyx()
+        self.stdscr.move(end_y + 1, 0)
+        self.stdscr.clrtobot()
+        self.stdscr.move(y, x)
+
+        if len(text) != 0:
+            string = string[:index] + text + string[index:]
+            self._insert(text, string[index:])
+            index = index + len(text)
+        else:
+            self.stdscr.addstr(end_y + 1, 0, tips)
+            self.stdscr.move(y, x)
+        return string, index
+
+    def _insert(self, text, tail):
+        """Insert text at the cursor and move the cursor past it
+
+        Parameters
+        ----------
+        text : string
+            The text to insert
+        tail : string
+            The input from the cursor to the end, starting with text
+        """
+        if self._fits(len(tail)):
+            self.stdscr.insstr(text)
+            self._move(len(text))
+        else: # insstr does not wrap, redraw the tail
+            self.stdscr.addstr(tail)
+            self._move(len(text) - len(tail))
+
+    def _delete(self, tail):
+        """Delete the character under the cursor
+
+        Parameters
+        ----------
+        tail : string
+            The input from the cursor to the end, after the deletion
+        """
+        if self._fits(len(tail) + 1):
+            self.stdscr.delch()
+        else: # delch does not wrap, redraw the tail
+            self.stdscr.addstr(tail + " ")
+            self._move(-len(tail) - 1)
+
+    def _fits(self, length):
+        """Check if text of a given length at the cursor fits on its line
+
+        Parameters
+        ----------
+        length : integer
+            Number of characters
+
+        Returns
+        -------
+        bool
+            True if the text ends before the last column.
+        """
+        y, x = self.stdscr.getyx()
+        height, width = self.stdscr.getmaxyx()
+        return x + length < width
+
+    def _move(self, offset):
+        """Move the cursor along the input, following line wraps
+
+        Parameters
+        ----------
+        offset : integer
+            Number of characters to move, negative to move back.
+        """
+        y, x = self.stdscr.getyx()
+        height, width = self.stdscr.getmaxyx()
+        position = y*width + x + offset
+        self.stdscr.move(position//width, position%width)
+
+    def _getkey(self, timeout):
+        """Get a key press
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait for a key press. If None, wait indefinitely.
+
+        Returns
+        -------
+        string
+            The key, or None if no key was pressed before the timeout.
+        """
+        if timeout is None:
+            self.keys.timeout(-1)
+        else:
+            self.keys.timeout(int(timeout*1000))
+
+        try:
+            return self.keys.getkey()
+        except curses.error:
+            return None
+
+    def _refresh(self):
+        """Draw all pending changes to the screen
+        """
+        self.stdscr.noutrefresh()
+        curses.doupdate()